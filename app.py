@@ -1,13 +1,23 @@
-from typing import Any
-import psycopg2
-from psycopg2 import Error
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Iterable
+from psycopg2 import Error, sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+import inflect
+import orjson
 import os
+import time
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ValidationError
+from starlette.concurrency import run_in_threadpool
 import uvicorn
 import requests
+from requests.adapters import HTTPAdapter, Retry
 
 
 class Metadata(BaseModel):
@@ -17,35 +27,72 @@ class Metadata(BaseModel):
     columns: list[str]  # list of column names that require insertion
 
 
-connection = None
-cursor = None
+class TableData(BaseModel):
+    metadata: Metadata
+    payload: list[Any]
+
+
 load_dotenv()
-try:
-    connection = psycopg2.connect(user=os.environ.get('POSTGRES_USER'),
-                                  password=os.environ.get('POSTGRES_PASSWORD'),
-                                  host="postgres",
-                                  port=os.environ.get('POSTGRES_PORT'),
-                                  database=os.environ.get('POSTGRES_DB'))
-    cursor = connection.cursor()
-    app = FastAPI(port=os.environ.get('PORT'))
-    app.add_middleware(
-        CORSMiddleware,
-        allow_origins=["http://localhost", "http://scraper"],
-        # only allow from specific places, this service executes arbitrary SQL
-        allow_methods=["*"],
-        allow_headers=["*"],
-    )
-except (Exception, Error) as error:
-    print("Error while connecting to PostgreSQL", error)
-    if connection:
-        connection.close()
-        if cursor:
-            cursor.close()
-        print("PostgreSQL connection is closed")
+
+# Pool of connections - acquired per request so concurrent requests
+# don't serialise on a single shared connection/cursor
+pool = None
+
+app = FastAPI(port=os.environ.get('PORT'), default_response_class=ORJSONResponse)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost", "http://scraper"],
+    # only allow from specific places, this service executes arbitrary SQL
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.on_event("startup")
+def create_connection_pool():
+    global pool
+    # Postgres may not be accepting connections yet (e.g. during a
+    # rolling restart) - retry with backoff instead of dying immediately
+    for attempt in range(10):
+        try:
+            pool = ThreadedConnectionPool(minconn=2, maxconn=10,
+                                          user=os.environ.get('POSTGRES_USER'),
+                                          password=os.environ.get('POSTGRES_PASSWORD'),
+                                          host="postgres",
+                                          port=os.environ.get('POSTGRES_PORT'),
+                                          database=os.environ.get('POSTGRES_DB'))
+            return
+        except (Exception, Error) as error:
+            print("Error while connecting to PostgreSQL", error)
+            time.sleep(min(0.2 * 2 ** attempt, 5))
+    print("Could not connect to PostgreSQL, giving up")
     exit(1)
 
 
-def create_table(metadata: Metadata) -> bool:
+@app.on_event("shutdown")
+def close_connection_pool():
+    if pool:
+        pool.closeall()
+        print("PostgreSQL connection pool is closed")
+
+
+@contextmanager
+def get_connection():
+    """Acquire a connection from the pool, returning it when done."""
+    connection = pool.getconn()
+    try:
+        yield connection
+    finally:
+        pool.putconn(connection)
+
+
+# In-process cache of each table's (up, down) as stored in Tables -
+# sql_up only changes on deploy, so the steady-state path can skip the
+# metadata SELECT entirely
+table_sql_cache: dict[str, tuple[str, str]] = {}
+
+
+def create_table(metadata: Metadata, cursor) -> bool:
     """
     Create table as specified in metadata.
 
@@ -55,8 +102,13 @@ def create_table(metadata: Metadata) -> bool:
 
     Returns whether the table was created or not.
     """
-    cmd = f"SELECT up, down FROM Tables WHERE table_name = %s"
     metadata.table_name = metadata.table_name.lower()
+
+    cached = table_sql_cache.get(metadata.table_name)
+    if cached and cached[0] == metadata.sql_up:
+        return False
+
+    cmd = f"SELECT up, down FROM Tables WHERE table_name = %s"
     cursor.execute(cmd, (metadata.table_name,))
     table_sql = cursor.fetchone()
     if not table_sql:
@@ -67,6 +119,7 @@ def create_table(metadata: Metadata) -> bool:
         cmd = f"INSERT INTO Tables(table_name, up, down) VALUES (%s, %s, %s)"
         cursor.execute(cmd, (metadata.table_name, metadata.sql_up, metadata.sql_down))
 
+        table_sql_cache[metadata.table_name] = (metadata.sql_up, metadata.sql_down)
         return True
     elif table_sql[0] != metadata.sql_up:
         # Re-create
@@ -77,13 +130,25 @@ def create_table(metadata: Metadata) -> bool:
         cmd = f"UPDATE Tables SET up = %s, down = %s WHERE table_name = %s"
         cursor.execute(cmd, (metadata.sql_up, metadata.sql_down, metadata.table_name))
 
+        table_sql_cache[metadata.table_name] = (metadata.sql_up, metadata.sql_down)
         return True
 
+    table_sql_cache[metadata.table_name] = table_sql
     return False
 
 
+# Session keeps the TCP connection to graphql-engine alive across calls,
+# retrying briefly in case it is still starting up
+hasura_session = requests.Session()
+hasura_session.mount("http://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.1)
+))
+
+
 def send_hasura_api_query(query: object):
-    return requests.post(
+    return hasura_session.post(
         "http://graphql-engine:8080/v1/metadata",
         headers={
             "X-Hasura-Admin-Secret": os.environ.get("HASURA_GRAPHQL_ADMIN_SECRET")
@@ -94,13 +159,17 @@ def send_hasura_api_query(query: object):
 
 # The below functions are used to adhere to Hasura's relationship nomenclature
 # https://hasura.io/docs/latest/schema/postgres/using-existing-database/
-# Possibly use the `inflect` module if they aren't sufficient
+inflector = inflect.engine()
+
+
+@lru_cache(maxsize=1024)
 def plural(s: str) -> str:
-    return s if s.endswith("s") else s + "s"
+    return s if inflector.singular_noun(s) else inflector.plural_noun(s)
 
 
+@lru_cache(maxsize=1024)
 def singular(s: str) -> str:
-    return s if not s.endswith("s") else s[:-1]
+    return inflector.singular_noun(s) or s
 
 
 def infer_relationships(table_name: str) -> list[object]:
@@ -153,65 +222,360 @@ def infer_relationships(table_name: str) -> list[object]:
     return queries
 
 
-@app.post("/insert")
-def insert(metadata: Metadata, payload: list[Any]):
+def get_primary_key(table_name: str, cursor) -> list[str]:
+    """Fetch the primary key column(s) of the given table."""
+    cmd = """
+        SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid
+                           AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+    """
+    cursor.execute(cmd, (table_name,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+# NULL marker for the COPY stream - csv's default of an unquoted empty
+# field would make None and '' indistinguishable
+NULL_MARKER = '\\N'
+
+
+def encode_csv_field(value: Any) -> str:
+    """
+    Encode a single value for the COPY CSV stream.
+
+    None becomes the unquoted NULL marker; strings that could be
+    mistaken for it (or contain CSV syntax) are quoted, which COPY
+    never reads as NULL.
+    """
+    if value is None:
+        return NULL_MARKER
+    s = str(value)
+    if s == "" or s == NULL_MARKER or any(c in s for c in ',"\r\n'):
+        return '"' + s.replace('"', '""') + '"'
+    return s
+
+
+class RowStream:
+    """
+    Read-only file-like view of an iterable of rows, encoding them as
+    CSV on demand as copy_expert reads. Keeps memory constant in the
+    payload size rather than holding the full CSV text at once.
+    """
+    def __init__(self, rows: Iterable[tuple]):
+        self._rows = iter(rows)
+        self._remainder = ""
+
+    def read(self, size: int = -1) -> str:
+        parts = [self._remainder]
+        self._remainder = ""
+        length = len(parts[0])
+        while size < 0 or length < size:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                break
+            line = ",".join(map(encode_csv_field, row)) + "\r\n"
+            parts.append(line)
+            length += len(line)
+        data = "".join(parts)
+        if 0 <= size < len(data):
+            self._remainder = data[size:]
+            data = data[:size]
+        return data
+
+
+def copy_values(table_name: str, columns: tuple[str, ...], values: Iterable[tuple], cursor):
+    """COPY the given rows into the given table - Postgres's bulk load path."""
+    cmd = sql.SQL("COPY {}({}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')").format(
+        sql.Identifier(table_name), build_column_list(columns))
+    cursor.copy_expert(cmd, RowStream(values))
+
+
+@lru_cache(maxsize=256)
+def build_column_list(columns: tuple[str, ...]) -> sql.Composed:
+    """Compose the given column names into a properly quoted list."""
+    return sql.SQL(', ').join(map(sql.Identifier, columns))
+
+
+@lru_cache(maxsize=256)
+def build_conflict_clause(columns: tuple[str, ...], primary_key: tuple[str, ...]) -> sql.Composed:
+    """Compose the ON CONFLICT clause upserting the non-key columns."""
+    pk_list = build_column_list(primary_key)
+    updates = [sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(col))
+               for col in columns if col not in primary_key]
+    if updates:
+        return sql.SQL('ON CONFLICT ({}) DO UPDATE SET {}').format(
+            pk_list, sql.SQL(', ').join(updates))
+    return sql.SQL('ON CONFLICT ({}) DO NOTHING').format(pk_list)
+
+
+@lru_cache(maxsize=256)
+def build_insert_cmd(table_name: str, columns: tuple[str, ...],
+                     primary_key: tuple[str, ...]) -> sql.Composed:
+    """
+    Compose the INSERT command for execute_values, upserting if a
+    primary key is given.
+
+    Quoting of identifiers is done by psycopg2.sql, and happens once
+    per (table, columns) combination thanks to the cache.
+    """
+    cmd = sql.SQL('INSERT INTO {}({}) VALUES %s').format(
+        sql.Identifier(table_name), build_column_list(columns))
+    if primary_key:
+        cmd = sql.SQL(' ').join([cmd, build_conflict_clause(columns, primary_key)])
+    return cmd
+
+
+def row_getter(columns: list[str]):
+    """
+    Build a function extracting the given columns from a row as a tuple.
+
+    itemgetter runs at C speed, but returns a bare value rather than a
+    tuple when given a single key, so that case is special-cased.
+    """
+    if len(columns) == 1:
+        col = columns[0]
+        return lambda row: (row[col],)
+    return itemgetter(*columns)
+
+
+def get_upsert_key(metadata: Metadata, cursor) -> tuple[str, ...]:
+    """
+    Fetch the primary key columns to upsert on, or an empty tuple if
+    the table has no primary key within the inserted columns (in which
+    case the load must truncate+reload instead).
+    """
+    primary_key = tuple(get_primary_key(metadata.table_name, cursor))
+    if primary_key and set(primary_key) <= set(metadata.columns):
+        return primary_key
+    return ()
+
+
+def insert_data(metadata: Metadata, payload: list[Any], cursor,
+                primary_key: tuple[str, ...] = None, truncate: bool = True):
+    """
+    Load the given payload into the table specified in metadata, so that
+    afterwards the table contains exactly the rows of the payload.
+
+    If the table has a primary key, rows are upserted with ON CONFLICT
+    and stale rows deleted with a set difference - unchanged rows are
+    untouched and no AccessExclusive lock is taken. Tables without a
+    primary key in the inserted columns fall back to truncate+reload;
+    truncate=False skips the TRUNCATE when the caller has already
+    emptied the table.
+    """
+    if primary_key is None:
+        primary_key = get_upsert_key(metadata, cursor)
+    getter = row_getter(metadata.columns)
+    columns = tuple(metadata.columns)
+    table = sql.Identifier(metadata.table_name)
+
+    if not primary_key:
+        if truncate:
+            cursor.execute(sql.SQL('TRUNCATE {} CASCADE').format(table))
+        if len(payload) > 1024:
+            # Rows are streamed into COPY without materialising a
+            # second full copy of the payload
+            copy_values(metadata.table_name, columns, map(getter, payload), cursor)
+        else:
+            execute_values(cursor, build_insert_cmd(metadata.table_name, columns, ()),
+                           list(map(getter, payload)), page_size=1000)
+        return
+
+    if len(payload) > 1024:
+        # COPY into a temp table, then upsert into the real one in a
+        # single INSERT ... SELECT
+        tmp = f'tmp_{metadata.table_name}'
+        cursor.execute(sql.SQL('CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP')
+                       .format(sql.Identifier(tmp), table))
+        copy_values(tmp, columns, map(getter, payload), cursor)
+        cursor.execute(sql.SQL('INSERT INTO {}({}) SELECT {} FROM {} {}').format(
+            table, build_column_list(columns), build_column_list(columns),
+            sql.Identifier(tmp), build_conflict_clause(columns, primary_key)))
+    else:
+        execute_values(cursor, build_insert_cmd(metadata.table_name, columns, primary_key),
+                       list(map(getter, payload)), page_size=1000)
+
+    # Delete rows no longer present in the payload
+    if len(primary_key) == 1:
+        keys = list(map(itemgetter(primary_key[0]), payload))
+        cursor.execute(sql.SQL('DELETE FROM {} WHERE {} != ALL(%s)').format(
+            table, sql.Identifier(primary_key[0])), (keys,))
+    else:
+        keys = tuple(map(itemgetter(*primary_key), payload))
+        if keys:
+            cursor.execute(sql.SQL('DELETE FROM {} WHERE ({}) NOT IN %s').format(
+                table, build_column_list(primary_key)), (keys,))
+        else:
+            cursor.execute(sql.SQL('DELETE FROM {}').format(table))
+
+
+def track_table(table_name: str):
+    """
+    Run Hasura actions to track the given table - must be done after
+    the transaction creating it is committed.
+    """
+    # Track table and allow anonymous access in a single bulk query
+    # to avoid multiple round-trips
+    send_hasura_api_query({
+        "type": "bulk",
+        "args": [
+            {
+                "type": "pg_track_table",
+                "args": {
+                    "source": "default",
+                    "schema": "public",
+                    "name": table_name
+                }
+            },
+            {
+                "type": "pg_create_select_permission",
+                "args": {
+                    "source": "default",
+                    "table": table_name,
+                    "role": "anonymous",
+                    "permission": {
+                        "columns": "*",
+                        "filter": {},
+                        "allow_aggregations": True
+                    }
+                }
+            }
+        ]
+    })
+
+    # Track relationships - table must already be tracked for
+    # pg_suggest_relationships to pick it up
+    send_hasura_api_query({
+        "type": "bulk",
+        "args": infer_relationships(table_name)
+    })
+
+
+async def parse_body(request: Request) -> Any:
+    """
+    Parse the request body with orjson - noticeably faster than the
+    stdlib json parser FastAPI uses for large payloads.
+    """
     try:
-        created = create_table(metadata)
-    except (Exception, Error) as error:
-        print("Error while creating PostgreSQL table:", error)
-        connection.rollback()
-        return {"status": "error", "error": str(error)}
+        return orjson.loads(await request.body())
+    except orjson.JSONDecodeError as error:
+        raise HTTPException(status_code=422, detail=str(error))
 
+
+@app.post("/insert")
+async def insert(request: Request):
     try:
-        # Remove old data
-        cmd = f'TRUNCATE {metadata.table_name} CASCADE'
-        cursor.execute(cmd)
-
-        # Insert new data
-        values = [tuple(row[col] for col in metadata.columns) for row in payload]
-        metadata.columns = [f'"{col}"' for col in metadata.columns]
-        cmd = f'INSERT INTO {metadata.table_name}({", ".join(metadata.columns)}) VALUES ({", ".join(["%s"] * len(metadata.columns))})'
-        cursor.executemany(cmd, values)
-    except (Exception, Error) as error:
-        print("Error while inserting into PostgreSQL table:", error)
-        connection.rollback()
-        return {"status": "error", "error": str(error)}
-
-    connection.commit()
-
-    # Run Hasura actions - must be done after transaction committed
+        data = TableData(**await parse_body(request))
+    except (ValidationError, TypeError) as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    return await run_in_threadpool(do_insert, data.metadata, data.payload)
+
+
+def do_insert(metadata: Metadata, payload: list[Any]):
+    insert_error = None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            created = create_table(metadata, cursor)
+        except (Exception, Error) as error:
+            print("Error while creating PostgreSQL table:", error)
+            connection.rollback()
+            return {"status": "error", "error": str(error)}
+
+        # Savepoint so a failed load only discards the partial insert -
+        # any table (re-)creation above still commits and is tracked
+        cursor.execute('SAVEPOINT data_load')
+        try:
+            insert_data(metadata, payload, cursor)
+        except (Exception, Error) as error:
+            print("Error while inserting into PostgreSQL table:", error)
+            cursor.execute('ROLLBACK TO SAVEPOINT data_load')
+            insert_error = error
+
+        try:
+            connection.commit()
+        except (Exception, Error) as error:
+            print("Error while committing to PostgreSQL:", error)
+            # The cache was populated during the transaction and now
+            # claims schema changes that never landed
+            table_sql_cache.pop(metadata.table_name.lower(), None)
+            return {"status": "error", "error": str(error)}
+        cursor.close()
+
     if created:
-        # Track table
-        send_hasura_api_query({
-            "type": "pg_track_table",
-            "args": {
-                "source": "default",
-                "schema": "public",
-                "name": metadata.table_name.lower()
-            }
-        })
-
-        # Allow anonymous access
-        send_hasura_api_query({
-            "type": "pg_create_select_permission",
-            "args": {
-                "source": "default",
-                "table": metadata.table_name.lower(),
-                "role": "anonymous",
-                "permission": {
-                    "columns": "*",
-                    "filter": {},
-                    "allow_aggregations": True
-                }
-            }
-        })
+        track_table(metadata.table_name.lower())
+
+    if insert_error:
+        return {"status": "error", "error": str(insert_error)}
+    return {"status": "success"}
 
-        # Track relationships
-        send_hasura_api_query({
-            "type": "bulk",
-            "args": infer_relationships(metadata.table_name.lower())
-        })
 
+@app.post("/insert_many")
+async def insert_many(request: Request):
+    try:
+        tables = [TableData(**table) for table in await parse_body(request)]
+    except (ValidationError, TypeError) as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    return await run_in_threadpool(do_insert_many, tables)
+
+
+def do_insert_many(tables: list[TableData]):
+    insert_error = None
+    with get_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            created = [create_table(table.metadata, cursor) for table in tables]
+        except (Exception, Error) as error:
+            print("Error while creating PostgreSQL table:", error)
+            connection.rollback()
+            # Earlier tables in the list were cached before the rollback
+            for table in tables:
+                table_sql_cache.pop(table.metadata.table_name.lower(), None)
+            return {"status": "error", "error": str(error)}
+
+        # Savepoint so a failed load only discards the partial inserts -
+        # any table (re-)creation above still commits and is tracked
+        cursor.execute('SAVEPOINT data_load')
+        try:
+            upsert_keys = [get_upsert_key(table.metadata, cursor) for table in tables]
+
+            # Truncate every fallback table in one statement before any
+            # loads - the dependency graph is walked once, and a later
+            # table's CASCADE can't wipe rows already loaded for an
+            # earlier table in the batch
+            fallback = [table.metadata.table_name
+                        for table, key in zip(tables, upsert_keys) if not key]
+            if fallback:
+                cursor.execute(sql.SQL('TRUNCATE {} CASCADE').format(
+                    sql.SQL(', ').join(map(sql.Identifier, fallback))))
+
+            for table, key in zip(tables, upsert_keys):
+                insert_data(table.metadata, table.payload, cursor,
+                            primary_key=key, truncate=False)
+        except (Exception, Error) as error:
+            print("Error while inserting into PostgreSQL table:", error)
+            cursor.execute('ROLLBACK TO SAVEPOINT data_load')
+            insert_error = error
+
+        try:
+            connection.commit()
+        except (Exception, Error) as error:
+            print("Error while committing to PostgreSQL:", error)
+            # The cache was populated during the transaction and now
+            # claims schema changes that never landed
+            for table in tables:
+                table_sql_cache.pop(table.metadata.table_name.lower(), None)
+            return {"status": "error", "error": str(error)}
+        cursor.close()
+
+    for table, was_created in zip(tables, created):
+        if was_created:
+            track_table(table.metadata.table_name.lower())
+
+    if insert_error:
+        return {"status": "error", "error": str(insert_error)}
     return {"status": "success"}
 
 